@@ -4,33 +4,51 @@ main.py — JMA RAG Prototype (PostgreSQL + pgvector + Llama 3.2 Instruct + pyth
 What this script does:
 1) Connects to PostgreSQL (expects pgvector extension enabled).
 2) (Optional) Loads schema/data if you call initialise_database(schema_path).
-3) Embeds Knowledge_Entries and stores embeddings (vector(768)).
+3) Embeds Knowledge_Entries and stores embeddings (halfvec(384), MiniLM's native size).
 4) For each Client: retrieves top-K semantically similar snippets + stakeholder facts.
 5) Builds a strict JSON prompt (persona, context, tone, guardrails).
-6) Calls Llama 3.2 Instruct via Hugging Face Transformers to produce JSON.
+6) Calls Llama 3.2 Instruct via Hugging Face Transformers (or vLLM) to produce JSON, all clients batched.
 7) Assembles a structured .docx (cover, stakeholders, Exec Summary, DAAEG, KPIs, Risks, Sources, Enrichment).
 8) Saves the JSON “gold copy” back into Knowledge_Entries with an embedding for retrieval.
 
 Environment variables you may set:
-  PGHOST, PGPORT, PGUSER, PGPASSWORD, PGDATABASE
+  PGHOST, PGPORT, PGUSER, PGPASSWORD, PGDATABASE, PGCONNECT_TIMEOUT (seconds, default 10)
+  PG_POOL_MIN, PG_POOL_MAX (connection pool bounds, default 1 / 8)
+  HNSW_EF_SEARCH (HNSW candidate list size per query; higher = better recall, slower)
+  HNSW_ITERATIVE_SCAN (filtered-scan mode, default strict_order; used only on pgvector >= 0.8; "off" disables)
+  LLM_BACKEND (hf | vllm, default hf), LLM_BATCH_SIZE (prompts per HF forward pass, default 4)
+  EMBED_BACKEND (torch | onnx; onnx = int8 ONNX Runtime on CPU-only hosts), EMBED_ONNX_FILE
+  TORCH_NUM_THREADS (CPU threads for embedding/generation; default: torch's own choice)
+  DOCX_PARALLEL_MIN (deliverables needed before rendering uses worker processes, default 32)
   HF_HOME / (run `huggingface-cli login` once to cache credentials)
 
 Requirements are listed in requirements.txt.
 """
 
 import os
-import json
+import re
 import hashlib
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any, Tuple
+from typing import TYPE_CHECKING, List, Dict, Any, Tuple
 
+import numpy as np
+import orjson
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 from pgvector.psycopg2 import register_vector
 
-from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+# torch, sentence-transformers and transformers take seconds to import and are only
+# needed once a model is loaded, so they are imported inside load_embedder/load_llm.
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 from docx import Document  # python-docx
 
@@ -38,17 +56,72 @@ from docx import Document  # python-docx
 # Configuration & Connections
 # -----------------------------
 
-def get_db_connection():
-    conn = psycopg2.connect(
+def _db_params() -> Dict[str, str]:
+    return dict(
         dbname=os.getenv("PGDATABASE", "jma_knowledge_base"),
         user=os.getenv("PGUSER", "postgres"),
         password=os.getenv("PGPASSWORD", ""),
         host=os.getenv("PGHOST", "localhost"),
         port=os.getenv("PGPORT", "5432"),
+        # libpq waits indefinitely by default; fail fast when the server is unreachable
+        connect_timeout=os.getenv("PGCONNECT_TIMEOUT", "10"),
     )
+
+def get_db_connection():
+    conn = psycopg2.connect(**_db_params())
     register_vector(conn)
     return conn
 
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "8"))
+
+_pool = None
+
+class PooledConnection(psycopg2.extensions.connection):
+    # register_vector's typecasters are per connection; the flag lives on the connection
+    # itself so it dies with it (pooled connections get closed and replaced over time)
+    vector_registered = False
+
+def get_db_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    global _pool
+    if _pool is None:
+        _pool = psycopg2.pool.ThreadedConnectionPool(PG_POOL_MIN, PG_POOL_MAX,
+                                                     connection_factory=PooledConnection,
+                                                     **_db_params())
+    return _pool
+
+@contextmanager
+def db_connection():
+    # Borrow a pooled connection instead of paying connect + register_vector every time.
+    # On return the pool either keeps the connection (rolling back any open transaction)
+    # or, beyond PG_POOL_MIN idle connections, closes it.
+    pool = get_db_pool()
+    conn = pool.getconn()
+    if conn.closed:
+        # Dropped by the server since last use: discard it and take a fresh one
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    if not conn.vector_registered:
+        register_vector(conn)
+        conn.vector_registered = True
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+def close_db_pool():
+    global _pool
+    if _pool is not None:
+        _pool.closeall()
+        _pool = None
+
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "strict_order")
+
+# Anything but (Unicode) letters, digits, '_' and '-' in a client name becomes '_' in
+# its file name
+FILENAME_UNSAFE_RE = re.compile(r"[^\w-]+")
+
 def ensure_output_dir():
     out = Path("deliverables")
     out.mkdir(parents=True, exist_ok=True)
@@ -69,77 +142,286 @@ def initialise_database(schema_path: str):
     finally:
         conn.close()
 
+# Indexes the retrieval queries rely on, mirrored from schema.sql so databases created
+# from an older schema pick them up. IF NOT EXISTS makes this a catalog lookup once built.
+INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS stakeholders_client_id_idx ON stakeholders (client_id)",
+    "CREATE INDEX IF NOT EXISTS knowledge_entries_client_created_idx"
+    " ON knowledge_entries (client_id, created_at DESC)",
+    "CREATE INDEX IF NOT EXISTS knowledge_entries_stakeholder_id_idx"
+    " ON knowledge_entries (stakeholder_id)",
+    "CREATE INDEX IF NOT EXISTS knowledge_entries_embedding_hnsw"
+    " ON knowledge_entries USING hnsw (embedding halfvec_ip_ops)"
+    " WITH (m = 16, ef_construction = 64)",
+)
+
+# hnsw.iterative_scan only exists from pgvector 0.8; set by ensure_indexes() once the
+# installed version is known, so older (0.7) installs never see the SET
+_iterative_scan_supported = False
+
+def ensure_indexes():
+    global _iterative_scan_supported
+    with db_connection() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                for ddl in INDEX_DDL:
+                    cur.execute(ddl)
+                cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+                row = cur.fetchone()
+    version = tuple(int(p) for p in re.findall(r"\d+", row[0])[:2]) if row else (0, 0)
+    _iterative_scan_supported = version >= (0, 8)
+
 # -----------------------------
 # Embeddings
 # -----------------------------
 
-def fetch_knowledge_needing_embeddings(conn) -> List[dict]:
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+EMBED_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_BATCH_SIZE = 64
+# Output size of EMBED_MODEL_ID; must match the halfvec(384) column in schema.sql
+EMBED_DIM = 384
+HALFVEC_TYPE = f"halfvec({EMBED_DIM})"
+# CPU-only hosts can embed with a quantised ONNX export of the same model instead of
+# torch ("onnx" needs `pip install "sentence-transformers[onnx]"`). The hub repo ships
+# int8 exports per instruction set, e.g. onnx/model_qint8_avx512.onnx, model_qint8_arm64.onnx.
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+# CPU intra-op threads for torch; unset keeps torch's default (one per physical core)
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "0"))
+
+@functools.lru_cache(maxsize=1)
+def configure_torch():
+    import torch
+
+    if TORCH_NUM_THREADS > 0:
+        torch.set_num_threads(TORCH_NUM_THREADS)
+    try:
+        # Encode/generate parallelise inside each op; extra inter-op threads only contend
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Already fixed once parallel work has run in this process
+        pass
+
+# Loaders are cached: re-entering run() (or importing this module from another entry
+# point) reuses the loaded models instead of paying the multi-second load again
+@functools.lru_cache(maxsize=1)
+def load_embedder() -> "SentenceTransformer":
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    configure_torch()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cpu" and EMBED_BACKEND == "onnx":
+        # ONNX Runtime int8: several times faster than fp32 torch on CPU, same encode() API
+        embedder = SentenceTransformer(EMBED_MODEL_ID, device=device, backend="onnx",
+                                       model_kwargs={"file_name": EMBED_ONNX_FILE})
+    else:
+        embedder = SentenceTransformer(EMBED_MODEL_ID, device=device)
+    dim = embedder.get_sentence_embedding_dimension()
+    if dim != EMBED_DIM:
+        # Fail before any rows are written, not on the first INSERT/UPDATE
+        raise ValueError(f"{EMBED_MODEL_ID} produces {dim}-dim vectors; "
+                         f"schema.sql stores halfvec({EMBED_DIM})")
+    if device == "cuda":
+        # FP16 weights on GPU: tensor-core matmuls, half the memory traffic. Vectors are
+        # stored as halfvec anyway, so no precision is lost at rest.
+        embedder.half()
+    return embedder
+
+def embed_texts(embedder: "SentenceTransformer", texts: List[str], mp_pool=None):
+    # All embedding goes through here so texts are encoded in batched forward passes
+    if mp_pool is not None:
+        # encode() already length-sorts internally, but encode_multi_process splits the
+        # input into per-worker chunks first; sorting up front keeps each chunk's batches
+        # of similar length so little compute goes on padding. Rows are restored after.
+        order = np.argsort([len(t) for t in texts], kind="stable")
+        vecs = embedder.encode_multi_process([texts[i] for i in order], mp_pool,
+                                             batch_size=EMBED_BATCH_SIZE,
+                                             normalize_embeddings=True)
+        out = np.empty_like(vecs)
+        out[order] = vecs
+        return out
+    return embedder.encode(texts, batch_size=EMBED_BATCH_SIZE,
+                           normalize_embeddings=True, show_progress_bar=False)
+
+def start_multi_gpu_pool(embedder: "SentenceTransformer"):
+    # One worker per GPU for bulk encodes; None when there is at most one device
+    import torch
+
+    if torch.cuda.device_count() < 2:
+        return None
+    return embedder.start_multi_process_pool(
+        [f"cuda:{i}" for i in range(torch.cuda.device_count())])
+
+QUERY_CACHE_SIZE = 4096
+_query_cache: Dict[Tuple[Any, str], np.ndarray] = {}
+
+def embed_queries(embedder: "SentenceTransformer", texts: List[str]) -> List[np.ndarray]:
+    # Retrieval queries repeat across runs/clients; cache them to skip the forward pass,
+    # and encode whatever is missing in one batched call rather than one pass per query.
+    # Cached as read-only float16 arrays (768 bytes) rather than boxed Python floats.
+    # Arrays go to psycopg2 as-is: register_vector adapts ndarrays to pgvector literals.
+    missing = list(dict.fromkeys(t for t in texts if (embedder, t) not in _query_cache))
+    if missing:
+        for t, v in zip(missing, embed_texts(embedder, missing)):
+            vec = np.asarray(v, dtype=np.float16)
+            vec.flags.writeable = False
+            if len(_query_cache) >= QUERY_CACHE_SIZE:
+                # Evict the oldest entry (dicts keep insertion order)
+                del _query_cache[next(iter(_query_cache))]
+            _query_cache[(embedder, t)] = vec
+    return [_query_cache[(embedder, t)] for t in texts]
+
+BACKFILL_PAGE_SIZE = 512
+
+def fetch_knowledge_needing_embeddings(conn, after_id: int = 0,
+                                       limit: int = BACKFILL_PAGE_SIZE) -> List[Tuple[int, str]]:
+    # Keyset page over the primary key: each page is an index seek past after_id,
+    # so cost does not grow with how far the backfill has got.
+    # Plain (id, content) tuples: the backfill only needs these two columns
+    with conn.cursor() as cur:
         cur.execute("""
             SELECT id, content FROM knowledge_entries
-            WHERE embedding IS NULL
-        """)
-        return [dict(r) for r in cur.fetchall()]
-
-def store_embedding(conn, entry_id: int, emb: List[float]):
+            WHERE embedding IS NULL AND id > %s
+            ORDER BY id
+            LIMIT %s
+        """, (after_id, limit))
+        return cur.fetchall()
+
+# PostgreSQL binary COPY framing: signature, flags and header-extension length up front,
+# a -1 field count as trailer
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + np.zeros(2, dtype=">i4").tobytes()
+COPY_BINARY_TRAILER = np.array([-1], dtype=">i2").tobytes()
+# One COPY tuple of (id integer, embedding halfvec): field count, then length-prefixed
+# fields. halfvec's binary form is dim, unused, then big-endian float16 values.
+COPY_EMBEDDING_ROW = np.dtype([
+    ("nfields", ">i2"), ("id_len", ">i4"), ("id", ">i4"),
+    ("vec_len", ">i4"), ("dim", ">u2"), ("unused", ">u2"), ("vec", ">f2", (EMBED_DIM,)),
+])
+
+def copy_binary_embeddings(rows: List[Tuple[int, np.ndarray]]) -> BytesIO:
+    # Whole page encoded in one NumPy pass: 2 bytes per value on the wire and no float
+    # text formatting/parsing on either side
+    recs = np.zeros(len(rows), dtype=COPY_EMBEDDING_ROW)
+    recs["nfields"] = 2
+    recs["id_len"] = 4
+    recs["id"] = [entry_id for entry_id, _ in rows]
+    recs["vec_len"] = 4 + 2 * EMBED_DIM
+    recs["dim"] = EMBED_DIM
+    recs["vec"] = np.stack([v for _, v in rows])
+    return BytesIO(COPY_BINARY_HEADER + recs.tobytes() + COPY_BINARY_TRAILER)
+
+def store_embeddings(conn, rows: List[Tuple[int, np.ndarray]]):
+    # Binary COPY a backfill page into a session temp table, then one UPDATE ... FROM it.
+    # Pooled connections keep the temp table between pages; ON COMMIT DELETE ROWS empties it.
     with conn.cursor() as cur:
-        cur.execute(
-            "UPDATE knowledge_entries SET embedding = %s WHERE id = %s",
-            (emb, entry_id)
-        )
+        cur.execute(f"""
+            CREATE TEMP TABLE IF NOT EXISTS embedding_updates (id integer, embedding {HALFVEC_TYPE})
+            ON COMMIT DELETE ROWS
+        """)
+        cur.copy_expert("COPY embedding_updates (id, embedding) FROM STDIN WITH (FORMAT BINARY)",
+                        copy_binary_embeddings(rows))
+        cur.execute("""
+            UPDATE knowledge_entries ke SET embedding = u.embedding
+            FROM embedding_updates u
+            WHERE ke.id = u.id
+        """)
 
-def compute_and_store_embeddings(embedder: SentenceTransformer):
-    conn = get_db_connection()
+def compute_and_store_embeddings(embedder: "SentenceTransformer"):
+    # Page through pending rows so a cold start never holds the whole corpus in memory;
+    # each page is committed on its own, so an interrupted backfill resumes where it stopped.
+    # On multi-GPU hosts the backfill is sharded across devices; the pool is only started
+    # once there is work, as spawning one process per GPU is not free.
+    mp_pool = None
     try:
-        rows = fetch_knowledge_needing_embeddings(conn)
-        if not rows:
-            return
-        texts = [r["content"] for r in rows]
-        vecs = embedder.encode(texts, normalize_embeddings=True)
-        with conn:
-            for r, v in zip(rows, vecs):
-                store_embedding(conn, r["id"], v.tolist())
+        with db_connection() as conn:
+            last_id = 0
+            while True:
+                rows = fetch_knowledge_needing_embeddings(conn, after_id=last_id)
+                if not rows:
+                    return
+                if last_id == 0:
+                    mp_pool = start_multi_gpu_pool(embedder)
+                # Identical contents (re-imported notes, repeated boilerplate) are encoded once
+                texts = list(dict.fromkeys(content for _, content in rows))
+                by_text = dict(zip(texts, embed_texts(embedder, texts, mp_pool)))
+                with conn:
+                    store_embeddings(conn, [(entry_id, by_text[content]) for entry_id, content in rows])
+                last_id = rows[-1][0]
     finally:
-        conn.close()
+        if mp_pool is not None:
+            embedder.stop_multi_process_pool(mp_pool)
 
 # -----------------------------
 # Retrieval
 # -----------------------------
 
-def load_client_and_stakeholders(conn, client_id: int) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        cur.execute("SELECT id, name FROM clients WHERE id = %s", (client_id,))
-        client = cur.fetchone()
-        if not client:
-            raise ValueError(f"Client {client_id} not found")
-        cur.execute("""
-            SELECT id, name, role, tone, priority1, priority2, priority3
-            FROM stakeholders WHERE client_id = %s
-        """, (client_id,))
-        st = cur.fetchall()
-    client_d = {"id": client["id"], "name": client["name"]}
-    stakeholders = []
-    for s in st:
-        stakeholders.append({
-            "id": s["id"],
-            "name": s["name"],
-            "role": s["role"],
-            "tone": s["tone"],
-            "priorities": [p for p in [s["priority1"], s["priority2"], s["priority3"]] if p]
-        })
-    return client_d, stakeholders
-
-def semantic_retrieve(conn, client_id: int, embedder: SentenceTransformer, query_text: str, top_k: int = 5) -> List[Dict[str, Any]]:
-    qvec = embedder.encode([query_text], normalize_embeddings=True)[0].tolist()
+# One row per client with its stakeholders nested as a JSON array built by Postgres,
+# so client columns are not repeated per stakeholder and Python does no regrouping.
+# FILTER drops the all-NULL row a LEFT JOIN yields for clients with no stakeholders.
+CLIENT_STAKEHOLDERS_SQL = """
+    SELECT c.id, c.name,
+           COALESCE(
+               jsonb_agg(jsonb_build_object(
+                   'id', s.id, 'name', s.name, 'role', s.role, 'tone', s.tone,
+                   'priorities', to_jsonb(array_remove(array_remove(
+                       ARRAY[s.priority1, s.priority2, s.priority3], NULL), ''))
+               ) ORDER BY s.id) FILTER (WHERE s.id IS NOT NULL),
+               '[]'::jsonb
+           ) AS stakeholders
+    FROM clients c
+    LEFT JOIN stakeholders s ON s.client_id = c.id
+    GROUP BY c.id, c.name
+    ORDER BY c.id
+"""
+
+def load_all_clients_and_stakeholders(conn) -> List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    # Whole pipeline's client/stakeholder data in one round-trip instead of 1 + N
     with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute(CLIENT_STAKEHOLDERS_SQL)
+        return [({"id": r["id"], "name": r["name"]}, r["stakeholders"]) for r in cur.fetchall()]
+
+# Prompt context is capped per snippet; trimming (and flattening newlines) happens in SQL
+# so full entry bodies never cross the wire
+SNIPPET_CHARS = 500
+
+def semantic_retrieve(conn, client_id: int, qvec: np.ndarray,
+                      top_k: int = 5,
+                      ef_search: int = HNSW_EF_SEARCH) -> List[Dict[str, Any]]:
+    # Top-k runs in Postgres via pgvector, backed by the HNSW index. Embeddings are stored
+    # L2-normalised, so negative inner product (<#>) ranks like cosine distance without
+    # the per-candidate norm computation; similarity = -dist. qvec comes from embed_queries.
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        # Scoped to the current transaction. The client_id filter is applied to the HNSW
+        # candidates, so widen the list and let pgvector keep scanning until top_k rows pass
+        # the filter instead of returning short results for small clients.
+        cur.execute("SET LOCAL hnsw.ef_search = %s", (max(ef_search, top_k * 4),))
+        if HNSW_ITERATIVE_SCAN != "off" and _iterative_scan_supported:
+            cur.execute("SET LOCAL hnsw.iterative_scan = %s", (HNSW_ITERATIVE_SCAN,))
+        cur.execute(f"""
+            SELECT id, type, translate(left(content, %s), E'\\n', ' ') AS snippet, -dist AS similarity
+            FROM (
+                SELECT id, type, content, embedding <#> %s::{HALFVEC_TYPE} AS dist
+                FROM knowledge_entries
+                WHERE client_id = %s AND embedding IS NOT NULL
+                ORDER BY dist
+                LIMIT %s
+            ) ranked
+            ORDER BY dist
+        """, (SNIPPET_CHARS, qvec, client_id, top_k))
+        return cur.fetchall()
+
+def recent_entries(conn, client_id: int, limit: int = 5) -> List[Dict[str, Any]]:
+    # Fallback context: newest entries, limited in SQL rather than sliced in Python
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
         cur.execute("""
-            SELECT id, type, content
+            SELECT id, type, translate(left(content, %s), E'\\n', ' ') AS snippet
             FROM knowledge_entries
             WHERE client_id = %s
-            ORDER BY embedding <-> %s
+            ORDER BY created_at DESC, id DESC
             LIMIT %s
-        """, (client_id, qvec, top_k))
-        return [dict(r) for r in cur.fetchall()]
+        """, (SNIPPET_CHARS, client_id, limit))
+        return cur.fetchall()
 
 def build_query_from_stakeholders(stakeholders: List[Dict[str, Any]]) -> str:
     # Simple heuristic query: concatenate priorities and tone words
@@ -148,43 +430,32 @@ def build_query_from_stakeholders(stakeholders: List[Dict[str, Any]]) -> str:
         topics.extend(s.get("priorities", []))
         if s.get("tone"):
             topics.append(f"tone:{s['tone']}")
-    return " ; ".join(topics) or "project priorities; risks; timeline; cost; architecture"
+    # Drop repeats (shared priorities, tone words) so clients with the same vocabulary
+    # produce the same query string and hit the query-embedding cache. Only called when
+    # some stakeholder has priorities; clients without go to recent_entries instead.
+    return " ; ".join(dict.fromkeys(topics))
 
 # -----------------------------
 # Prompt Engineering (Strict JSON)
 # -----------------------------
 
-def build_prompt(client: Dict[str, Any],
-                 stakeholders: List[Dict[str, Any]],
-                 retrieved_snippets: List[Dict[str, Any]]) -> str:
-    # Persona + guardrails + structure
-    today = datetime.now().date().isoformat()
-    st_lines = "\n".join(
-        f"- {s['name']} ({s['role']}), tone={s['tone']}, priorities={', '.join(s['priorities'])}"
-        for s in stakeholders
-    ) or "- (no stakeholders found)"
-
-    ctx_lines = "\n".join(
-        f"[KE-{r['id']}] {r['content'][:500].replace(chr(10),' ')}"
-        for r in retrieved_snippets
-    ) or "(no context retrieved)"
-
-    prompt = f"""
+# Persona + guardrails + structure: identical for every client, so built once at import
+PROMPT_INSTRUCTIONS = """
 You are an expert consultant from Jacob Meadow Associates. Be objective and fact-based. Do NOT invent facts.
 Only use the provided context and stakeholder data. Avoid loaded or stereotypical language.
 
 Return STRICT JSON with keys:
-- cover: {{title, client, engagement, prepared_for, prepared_by, date, confidentiality}}
-- stakeholders: [{{name, role, tone, priorities: [..]}}]
-- executive_summary: {{paragraphs: [..], bullets: [..]}}
-- current_situation: {{bullets: [..], sources: [..]}}
-- recommendations: {{
+- cover: {title, client, engagement, prepared_for, prepared_by, date, confidentiality}
+- stakeholders: [{name, role, tone, priorities: [..]}]
+- executive_summary: {paragraphs: [..], bullets: [..]}
+- current_situation: {bullets: [..], sources: [..]}
+- recommendations: {
     discover: [..], analyze: [..], architect: [..], execute: [..], govern: [..]
-  }}
+  }
 - kpis: [..]
 - risks: [..]
 - sources: [..]
-- enrichment: {{gold_copy: true, knowledge_entry_id: "", model: "", prompt_hash: "", retrieval_ids: []}}
+- enrichment: {gold_copy: true, knowledge_entry_id: "", model: "", prompt_hash: "", retrieval_ids: []}
 
 Constraints:
 - Executive summary = 2 short paragraphs + 3 bullets (max).
@@ -192,13 +463,14 @@ Constraints:
 - Include at least 3 KPIs and 3 risks.
 - Use KE-style tags like [KE-1024] in 'sources' where appropriate.
 - Ensure tone consistency per stakeholder (direct vs collaborative) in phrasing.
+""".strip()
 
-Client: {client['name']}
-Stakeholders:
-{st_lines}
-
-Context (verbatim snippets for grounding):
-{ctx_lines}
+@functools.lru_cache(maxsize=8)
+def build_prompt_prefix(today: str) -> str:
+    # Everything that is identical for every client in a run comes first, so engines with
+    # prefix caching (vLLM) prefill these tokens once and reuse their KV blocks
+    return f"""
+{PROMPT_INSTRUCTIONS}
 
 Cover defaults (you may override):
 - title: "Client Readout – Executive Summary & Recommendations"
@@ -207,6 +479,32 @@ Cover defaults (you may override):
 - prepared_by: "Jacob Meadow Associates"
 - date: "{today}"
 - confidentiality: "Confidential – For Client Use Only"
+""".strip()
+
+def build_prompt(client: Dict[str, Any],
+                 stakeholders: List[Dict[str, Any]],
+                 retrieved_snippets: List[Dict[str, Any]],
+                 today: str = "") -> str:
+    today = today or datetime.now().date().isoformat()
+    st_lines = "\n".join(
+        f"- {s['name']} ({s['role']}), tone={s['tone']}, priorities={', '.join(s['priorities'])}"
+        for s in stakeholders
+    ) or "- (no stakeholders found)"
+
+    ctx_lines = "\n".join(
+        f"[KE-{r['id']}] {r['snippet']}"
+        for r in retrieved_snippets
+    ) or "(no context retrieved)"
+
+    prompt = f"""
+{build_prompt_prefix(today)}
+
+Client: {client['name']}
+Stakeholders:
+{st_lines}
+
+Context (verbatim snippets for grounding):
+{ctx_lines}
 
 Output: JSON ONLY.
 """.strip()
@@ -216,50 +514,210 @@ Output: JSON ONLY.
 # LLM Call (Llama 3.2 Instruct)
 # -----------------------------
 
+LLM_MODEL_ID = "meta-llama/Llama-3.2-3B-Instruct"
+LLM_MAX_NEW_TOKENS = 900
+# "hf" (Transformers pipeline) or "vllm" (paged-KV engine; needs `pip install vllm` and a GPU)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "hf")
+LLM_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "4"))
+
+@functools.lru_cache(maxsize=1)
 def load_llm():
+    # Returns (gen, model_id); gen maps a list of prompts to their completions
+    if LLM_BACKEND == "vllm":
+        return load_vllm(), LLM_MODEL_ID
+
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+
+    configure_torch()
+
     # Make sure you've run: huggingface-cli login
-    model_id = "meta-llama/Llama-3.2-3B-Instruct"
+    model_id = LLM_MODEL_ID
     tok = AutoTokenizer.from_pretrained(model_id)
-    mdl = AutoModelForCausalLM.from_pretrained(model_id)
-    gen = pipeline("text-generation", model=mdl, tokenizer=tok, max_new_tokens=900, temperature=0.2)
+    # Llama ships without a pad token; reuse EOS so prompts can be batched. Decoder-only
+    # models must be left-padded so every completion starts right after its prompt.
+    tok.pad_token = tok.pad_token or tok.eos_token
+    tok.padding_side = "left"
+    if torch.cuda.is_available():
+        # Half-precision weights placed across available GPUs: ~6 GB instead of ~12 GB
+        # and tensor-core matmuls. bf16 where supported (Ampere+), else fp16.
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        mdl = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=dtype, device_map="auto",
+                                                   attn_implementation="sdpa")
+    else:
+        mdl = AutoModelForCausalLM.from_pretrained(model_id, attn_implementation="sdpa")
+    # Greedy decoding: the report is strict JSON, so sampling only adds parse failures
+    pipe = pipeline("text-generation", model=mdl, tokenizer=tok, max_new_tokens=LLM_MAX_NEW_TOKENS,
+                    do_sample=False, pad_token_id=tok.pad_token_id)
+
+    def gen(prompts: List[str]) -> List[str]:
+        # return_full_text=False: only the completion, so the '{' search when parsing
+        # cannot land on the JSON schema braces inside the prompt itself
+        outs = pipe(prompts, return_full_text=False, batch_size=LLM_BATCH_SIZE)
+        return [o[0]["generated_text"] for o in outs]
+
     return gen, model_id
 
-def generate_report_with_llm(gen, prompt: str) -> str:
-    out = gen(prompt)[0]["generated_text"]
-    # Extract JSON from model output robustly (find first '{' to last '}')
+def _vllm_json_schema_kwargs() -> Dict[str, Any]:
+    # The guided-decoding API was renamed across vLLM releases (guided_decoding /
+    # GuidedDecodingParams, later structured_outputs / StructuredOutputsParams). Use whichever
+    # this install has; without either, generation is unconstrained like the HF backend
+    # and parse_report_json's repair/fallback path covers the output.
+    import vllm.sampling_params as sp
+    if hasattr(sp, "StructuredOutputsParams"):
+        return {"structured_outputs": sp.StructuredOutputsParams(json=REPORT_JSON_SCHEMA)}
+    if hasattr(sp, "GuidedDecodingParams"):
+        return {"guided_decoding": sp.GuidedDecodingParams(json=REPORT_JSON_SCHEMA)}
+    print("vLLM has no JSON-schema decoding API; generating unconstrained.")
+    return {}
+
+def load_vllm():
+    from vllm import LLM, SamplingParams
+
+    # One engine call for every prompt: PagedAttention schedules prefill and decode
+    # across requests instead of running the clients one after another
+    # enable_prefix_caching: the instructions/cover-defaults prefix is shared by every
+    # prompt (build_prompt_prefix), so its prefill runs once per run instead of per client
+    llm = LLM(model=LLM_MODEL_ID, dtype="auto", max_model_len=4096, enable_prefix_caching=True)
+    # Guided decoding masks every token that would break REPORT_JSON_SCHEMA, so no
+    # generation budget goes on prose around the JSON. A report longer than max_tokens is
+    # still cut off mid-object; parse_report_json falls back to the skeleton for those.
+    params = SamplingParams(max_tokens=LLM_MAX_NEW_TOKENS, temperature=0.0,
+                            **_vllm_json_schema_kwargs())
+
+    def gen(prompts: List[str]) -> List[str]:
+        return [o.outputs[0].text for o in llm.generate(prompts, params, use_tqdm=False)]
+
+    return gen
+
+# Trailing commas before a closing bracket, with any whitespace in between
+TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+# Recommendation headings, in order; (key, heading) pairs are precomputed once
+DAAEG_SECTIONS = ("discover", "analyze", "architect", "execute", "govern")
+DAAEG_HEADINGS = tuple((sec, sec.capitalize()) for sec in DAAEG_SECTIONS)
+
+# Skeleton used when the model output contains no JSON object. Serialised once at import;
+# orjson.loads of these bytes yields a fresh, independently mutable copy per call.
+FALLBACK_REPORT_JSON = orjson.dumps({
+    "cover": {"title": "Client Readout – Executive Summary & Recommendations",
+              "client": "UNKNOWN", "engagement": "RAG Knowledge Base Prototype",
+              "prepared_for": "Executive Sponsor", "prepared_by": "Jacob Meadow Associates",
+              "date": "",
+              "confidentiality": "Confidential – For Client Use Only"},
+    "stakeholders": [], "executive_summary": {"paragraphs": [], "bullets": []},
+    "current_situation": {"bullets": [], "sources": []},
+    "recommendations": {sec: [] for sec in DAAEG_SECTIONS},
+    "kpis": [], "risks": [], "sources": [], "enrichment": {"gold_copy": True, "knowledge_entry_id": "", "model": "", "prompt_hash": "", "retrieval_ids": []}
+})
+
+# JSON Schema mirroring the keys PROMPT_INSTRUCTIONS asks for. Backends that support
+# structured decoding (vLLM) constrain generation to it; only truncation at max_tokens
+# can still leave invalid JSON.
+_STR_LIST = {"type": "array", "items": {"type": "string"}}
+
+def _object(props: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "object", "properties": props, "required": list(props)}
+
+REPORT_JSON_SCHEMA = _object({
+    "cover": _object({k: {"type": "string"} for k in (
+        "title", "client", "engagement", "prepared_for", "prepared_by", "date", "confidentiality")}),
+    "stakeholders": {"type": "array", "items": _object({
+        "name": {"type": "string"}, "role": {"type": "string"}, "tone": {"type": "string"},
+        "priorities": _STR_LIST})},
+    "executive_summary": _object({"paragraphs": _STR_LIST, "bullets": _STR_LIST}),
+    "current_situation": _object({"bullets": _STR_LIST, "sources": _STR_LIST}),
+    "recommendations": _object({sec: _STR_LIST for sec in DAAEG_SECTIONS}),
+    "kpis": _STR_LIST,
+    "risks": _STR_LIST,
+    "sources": _STR_LIST,
+    "enrichment": _object({
+        "gold_copy": {"type": "boolean"}, "knowledge_entry_id": {"type": "string"},
+        "model": {"type": "string"}, "prompt_hash": {"type": "string"},
+        "retrieval_ids": _STR_LIST}),
+})
+
+def generate_reports_with_llm(gen, prompts: List[str], today: str = "") -> List[Dict[str, Any]]:
+    # All prompts go to the backend in one call so it can batch them
+    return [parse_report_json(out, today) for out in gen(prompts)]
+
+def parse_report_json(out: str, today: str = "") -> Dict[str, Any]:
+    # Returns the parsed report; callers serialise it once when it is persisted. A report
+    # whose sections have the wrong types (e.g. "enrichment": null from the unconstrained
+    # HF backend) is replaced by the skeleton, so it cannot crash enrichment or rendering
+    # and take the rest of the batch down with it.
+    report = _parse_report_json(out, today)
+    return report if _matches_schema(report, REPORT_JSON_SCHEMA) else fallback_report(today)
+
+def _matches_schema(value: Any, schema: Dict[str, Any]) -> bool:
+    # Type check against the subset of JSON Schema used by REPORT_JSON_SCHEMA. Missing keys
+    # are allowed: every reader falls back to a .get() default for them.
+    t = schema["type"]
+    if t == "object":
+        return isinstance(value, dict) and all(
+            _matches_schema(value[k], sub) for k, sub in schema["properties"].items() if k in value)
+    if t == "array":
+        return isinstance(value, list) and all(_matches_schema(v, schema["items"]) for v in value)
+    if t == "string":
+        return isinstance(value, str)
+    if t == "boolean":
+        return isinstance(value, bool)
+    return True
+
+def _parse_report_json(out: str, today: str = "") -> Dict[str, Any]:
+    # Schema-guided output is normally clean JSON: parse it directly. Anything but an
+    # object (or a truncated object) goes through the extraction/repair path below.
+    try:
+        report = orjson.loads(out)
+        if isinstance(report, dict):
+            return report
+    except orjson.JSONDecodeError:
+        pass
+    # Unconstrained output (HF backend): extract JSON from model output robustly
+    # (find first '{' to last '}')
     start = out.find("{")
     end = out.rfind("}")
     if start == -1 or end == -1 or end <= start:
-        # Fallback minimal JSON structure if parsing fails
-        return json.dumps({
-            "cover": {"title": "Client Readout – Executive Summary & Recommendations",
-                      "client": "UNKNOWN", "engagement": "RAG Knowledge Base Prototype",
-                      "prepared_for": "Executive Sponsor", "prepared_by": "Jacob Meadow Associates",
-                      "date": datetime.now().date().isoformat(),
-                      "confidentiality": "Confidential – For Client Use Only"},
-            "stakeholders": [], "executive_summary": {"paragraphs": [], "bullets": []},
-            "current_situation": {"bullets": [], "sources": []},
-            "recommendations": {"discover": [], "analyze": [], "architect": [], "execute": [], "govern": []},
-            "kpis": [], "risks": [], "sources": [], "enrichment": {"gold_copy": True, "knowledge_entry_id": "", "model": "", "prompt_hash": "", "retrieval_ids": []}
-        }, ensure_ascii=False)
+        return fallback_report(today)
     js = out[start:end+1]
     # Ensure it's valid JSON
     try:
-        json.loads(js)
-        return js
-    except json.JSONDecodeError:
-        # Try to fix trailing commas and retry (very light-touch)
-        js2 = js.replace(",]", "]").replace(",}", "}")
-        json.loads(js2)
-        return js2
+        return orjson.loads(js)
+    except orjson.JSONDecodeError:
+        pass
+    # Try to fix trailing commas and retry (very light-touch, single regex pass)
+    js2 = TRAILING_COMMA_RE.sub(r"\1", js)
+    try:
+        return orjson.loads(js2)
+    except orjson.JSONDecodeError:
+        # Still broken: one bad completion must not abort the other clients' reports
+        return fallback_report(today)
+
+def fallback_report(today: str = "") -> Dict[str, Any]:
+    # Fallback minimal JSON structure if parsing fails
+    report = orjson.loads(FALLBACK_REPORT_JSON)
+    report["cover"]["date"] = today or datetime.now().date().isoformat()
+    return report
 
 # -----------------------------
 # DOCX Assembly (python-docx)
 # -----------------------------
 
-def create_word_document_from_json(file_path: Path, json_text: str):
-    data = json.loads(json_text)
-    doc = Document()
+@functools.lru_cache(maxsize=1)
+def _base_document_bytes() -> bytes:
+    # python-docx's default template, read from disk once per process
+    buf = BytesIO()
+    Document().save(buf)
+    return buf.getvalue()
+
+def _add_paragraphs(doc, items: List[str], style=None):
+    for item in items:
+        doc.add_paragraph(item, style=style)
+
+def create_word_document(file_path: Path, data: Dict[str, Any]):
+    doc = Document(BytesIO(_base_document_bytes()))
+    # Resolve the bullet style once; passing the name re-scans the styles part per paragraph
+    bullet = doc.styles["List Bullet"]
 
     # Cover / Title block
     c = data.get("cover", {})
@@ -279,31 +737,29 @@ def create_word_document_from_json(file_path: Path, json_text: str):
     doc.add_heading("Key Stakeholders", level=1)
     st = data.get("stakeholders", [])
     if st:
-        tbl = doc.add_table(rows=1, cols=4)
-        hdr = tbl.rows[0].cells
-        hdr[0].text, hdr[1].text, hdr[2].text, hdr[3].text = "Name", "Role", "Tone", "Top Priorities"
-        for s in st:
-            row = tbl.add_row().cells
-            row[0].text = s.get("name","")
-            row[1].text = s.get("role","")
-            row[2].text = s.get("tone","")
-            row[3].text = "; ".join(s.get("priorities", []))
+        # Build every row in one add_table call, then fill the cells row by row, instead of
+        # growing the table with add_row() (which re-reads the column grid each time)
+        values = [("Name", "Role", "Tone", "Top Priorities")] + [
+            (s.get("name",""), s.get("role",""), s.get("tone",""), "; ".join(s.get("priorities", [])))
+            for s in st
+        ]
+        tbl = doc.add_table(rows=len(values), cols=4)
+        for row, vals in zip(tbl.rows, values):
+            for cell, text in zip(row.cells, vals):
+                cell.text = text
     else:
         doc.add_paragraph("No stakeholders found.")
 
     # Executive Summary
     doc.add_heading("Executive Summary", level=1)
     es = data.get("executive_summary", {})
-    for para in es.get("paragraphs", []):
-        doc.add_paragraph(para)
-    for b in es.get("bullets", []):
-        doc.add_paragraph(b, style="List Bullet")
+    _add_paragraphs(doc, es.get("paragraphs", []))
+    _add_paragraphs(doc, es.get("bullets", []), bullet)
 
     # Current Situation
     doc.add_heading("Current Situation Assessment", level=1)
     cs = data.get("current_situation", {})
-    for b in cs.get("bullets", []):
-        doc.add_paragraph(b, style="List Bullet")
+    _add_paragraphs(doc, cs.get("bullets", []), bullet)
     srcs = cs.get("sources", [])
     if srcs:
         doc.add_paragraph("Sources referenced in assessment: " + ", ".join(srcs))
@@ -311,126 +767,185 @@ def create_word_document_from_json(file_path: Path, json_text: str):
     # Recommendations (DAAEG)
     doc.add_heading("Key Recommendations (DAAEG)", level=1)
     recs = data.get("recommendations", {})
-    for sec in ["discover","analyze","architect","execute","govern"]:
-        doc.add_heading(sec.capitalize(), level=2)
-        for b in recs.get(sec, []):
-            doc.add_paragraph(b, style="List Bullet")
+    for sec, heading in DAAEG_HEADINGS:
+        doc.add_heading(heading, level=2)
+        _add_paragraphs(doc, recs.get(sec, []), bullet)
 
     # KPIs
     doc.add_heading("Expected Outcomes & KPIs", level=1)
-    for k in data.get("kpis", []):
-        doc.add_paragraph(k, style="List Bullet")
+    _add_paragraphs(doc, data.get("kpis", []), bullet)
 
     # Risks
     doc.add_heading("Risks & Mitigations", level=1)
-    for r in data.get("risks", []):
-        doc.add_paragraph(r, style="List Bullet")
+    _add_paragraphs(doc, data.get("risks", []), bullet)
 
     # Sources & Traceability
     doc.add_heading("Sources & Traceability", level=1)
-    for s in data.get("sources", []):
-        doc.add_paragraph(s, style="List Bullet")
+    _add_paragraphs(doc, data.get("sources", []), bullet)
 
     # Enrichment Metadata (Closed-Loop)
     doc.add_heading("Enrichment Metadata (Closed-Loop)", level=1)
     e = data.get("enrichment", {})
-    for line in [
+    _add_paragraphs(doc, [
         f"GoldCopy: {e.get('gold_copy', False)}",
         f"KnowledgeEntryId: {e.get('knowledge_entry_id','')}",
         f"Model: {e.get('model','')}",
         f"Prompt Hash: {e.get('prompt_hash','')}",
         "Retrieval Context IDs: " + ", ".join(e.get("retrieval_ids", [])),
-    ]:
-        doc.add_paragraph(line)
+    ])
 
     doc.save(str(file_path))
 
+# Each spawned worker re-imports numpy, psycopg2, pgvector, lxml and python-docx (a few
+# hundred ms) while one document renders in tens of ms, so small runs render in-process
+DOCX_PARALLEL_MIN = int(os.getenv("DOCX_PARALLEL_MIN", "32"))
+
+def create_word_documents(jobs: List[Tuple[Path, Dict[str, Any]]], overlap=None):
+    # python-docx is CPU-bound in lxml, and deliverables share no state, so large runs
+    # render in parallel processes. spawn (not fork) keeps workers clear of the parent's
+    # CUDA context. overlap, if given, runs in this process while the workers render.
+    workers = min(len(jobs), os.cpu_count() or 1)
+    if len(jobs) < DOCX_PARALLEL_MIN or workers < 2:
+        if overlap is not None:
+            overlap()
+        for file_path, data in jobs:
+            create_word_document(file_path, data)
+        return
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context("spawn")) as ex:
+        # map() submits every job up front, so rendering is under way before overlap starts
+        rendered = ex.map(create_word_document, *zip(*jobs))
+        if overlap is not None:
+            overlap()
+        list(rendered)
+
 # -----------------------------
 # Closed-loop: store gold copy
 # -----------------------------
 
-def insert_deliverable_json(client_id: int, json_text: str, embedder: SentenceTransformer):
-    conn = get_db_connection()
-    try:
-        vec = embedder.encode([json_text], normalize_embeddings=True)[0].tolist()
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO knowledge_entries (client_id, stakeholder_id, type, content, embedding)
-                    VALUES (%s, NULL, 'deliverable', %s, %s)
-                """, (client_id, json_text, vec))
-    finally:
-        conn.close()
+def deliverable_embedding_text(data: Dict[str, Any]) -> str:
+    # What a later retrieval should match on: the report's prose, not its JSON keys and
+    # cover boilerplate (which would also fill MiniLM's 256-token window on their own)
+    # HF output is not schema-constrained: tolerate missing, null or mistyped sections
+    es = data.get("executive_summary")
+    es = es if isinstance(es, dict) else {}
+    parts = []
+    for v in (es.get("paragraphs"), es.get("bullets"), data.get("kpis"), data.get("risks")):
+        if isinstance(v, list):
+            parts.extend(p for p in v if isinstance(p, str))
+    return " ".join(parts)
+
+def insert_deliverables(conn, deliverables: List[Tuple[int, str, str]], embedder: "SentenceTransformer"):
+    # deliverables: (client_id, json_text, embedding_text). The full JSON is stored, the
+    # embedding covers only embedding_text. All gold copies of a run are embedded in one
+    # batched encode and written in one multi-row INSERT.
+    if not deliverables:
+        return
+    vecs = embed_texts(embedder, [text for _, _, text in deliverables])
+    with conn:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO knowledge_entries (client_id, stakeholder_id, type, content, embedding)
+                VALUES %s
+            """, [(client_id, json_text, vec) for (client_id, json_text, _), vec in zip(deliverables, vecs)],
+                template=f"(%s, NULL, 'deliverable', %s, %s::{HALFVEC_TYPE})")
 
 # -----------------------------
 # Main pipeline
 # -----------------------------
 
 def run():
-    ensure_output_dir()
+    out_dir = ensure_output_dir()
 
     # Load embedder & LLM
-    embedder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+    embedder = load_embedder()
     gen, model_id = load_llm()
 
-    # Compute embeddings for any rows that are missing them
-    compute_and_store_embeddings(embedder)
-
-    # Iterate over clients
-    conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("SELECT id, name FROM clients ORDER BY id")
-            clients = cur.fetchall()
+        # Compute embeddings for any rows missing them, then make sure retrieval is
+        # index-backed. Building the HNSW index after the backfill is one bulk build instead
+        # of an incremental index update per updated row.
+        compute_and_store_embeddings(embedder)
+        ensure_indexes()
+
+        # One pooled connection for the whole client loop. Reads are wrapped in `with conn:`
+        # so no transaction (or SET LOCAL setting) stays open while the LLM is generating.
+        with db_connection() as conn:
+            # Iterate over clients (stakeholders are prefetched with them)
+            with conn:
+                clients = load_all_clients_and_stakeholders(conn)
+
+            # Build a retrieval query from stakeholder priorities and embed them all in one
+            # batch. Without priorities there is nothing to search for: those clients skip the
+            # query embedding and go straight to the recent-entries fallback.
+            queries = {i: build_query_from_stakeholders(stakeholders)
+                       for i, (_, stakeholders) in enumerate(clients)
+                       if any(s["priorities"] for s in stakeholders)}
+            qvecs = dict(zip(queries, embed_queries(embedder, list(queries.values()))))
+
+            # One report date for the whole run, shared by every prompt and fallback
+            today = datetime.now().date().isoformat()
+            retrievals = []
+            prompts = []
+            for i, (client_d, stakeholders) in enumerate(clients):
+                with conn:
+                    retrieved = []
+                    if i in qvecs:
+                        # Hybrid-ish: just a semantic retrieve using the query
+                        retrieved = semantic_retrieve(conn, client_d["id"], qvecs[i], top_k=5)
+                    if not retrieved:
+                        retrieved = recent_entries(conn, client_d["id"], limit=5)
+                retrievals.append(retrieved)
+
+                # Prompt
+                prompts.append(build_prompt(client_d, stakeholders, retrieved, today))
+
+            # LLM generate (JSON), every client in one batched call
+            reports = generate_reports_with_llm(gen, prompts, today)
+
+            docx_jobs = []
+            deliverables = []
+            used_names = set()
+            for (client_d, _), retrieved, prompt, data in zip(clients, retrievals, prompts, reports):
+                client_id = client_d["id"]
+                client_name = client_d["name"]
+
+                # Add model identity & prompt hash in the JSON payload (light touch)
+                e = data.get("enrichment", {})
+                e["model"] = e.get("model") or model_id
+                e["prompt_hash"] = e.get("prompt_hash") or hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:12]
+                e["retrieval_ids"] = e.get("retrieval_ids") or [f"KE-{r['id']}" for r in retrieved]
+                data["enrichment"] = e
+                # also ensure cover.client is set
+                cov = data.get("cover", {})
+                if not cov.get("client"):
+                    cov["client"] = client_name
+                data["cover"] = cov
+
+                # DOCX (rendered for all clients together below)
+                name = FILENAME_UNSAFE_RE.sub("_", client_name)
+                if name.casefold() in used_names:
+                    # Distinct clients that sanitise to the same name ("A/B", "A B"), compared
+                    # case-insensitively for macOS/Windows: keep them apart with the client id
+                    name = f"{name}_{client_id}"
+                used_names.add(name.casefold())
+                out_path = out_dir / f"deliverable_{name}.docx"
+                docx_jobs.append((out_path, data))
+
+                # Serialise once for the gold copy; embed its prose (or the JSON if there is none)
+                report_json = orjson.dumps(data).decode("utf-8")
+                deliverables.append((client_id, report_json, deliverable_embedding_text(data) or report_json))
+
+            # Render the .docx files in worker processes while this process embeds and stores
+            # the gold copies (closed loop), rather than one stage after the other
+            create_word_documents(docx_jobs,
+                                  overlap=lambda: insert_deliverables(conn, deliverables, embedder))
+
+        for (client_d, _), (out_path, _) in zip(clients, docx_jobs):
+            print(f"✓ Generated deliverable for {client_d['name']}: {out_path}")
     finally:
-        conn.close()
-
-    for c in clients:
-        client_id = c["id"]
-        client_name = c["name"]
-
-        conn = get_db_connection()
-        try:
-            client_d, stakeholders = load_client_and_stakeholders(conn, client_id)
-            # Build a retrieval query from stakeholder priorities
-            q = build_query_from_stakeholders(stakeholders)
-            # Hybrid-ish: just a semantic retrieve using the query
-            retrieved = semantic_retrieve(conn, client_id, embedder, q, top_k=5)
-        finally:
-            conn.close()
-
-        # Prompt
-        prompt = build_prompt(client_d, stakeholders, retrieved)
-
-        # LLM generate (JSON)
-        report_json = generate_report_with_llm(gen, prompt)
-
-        # Add model identity & prompt hash in the JSON payload (light touch)
-        try:
-            data = json.loads(report_json)
-        except Exception:
-            data = {}
-        e = data.get("enrichment", {})
-        e["model"] = e.get("model") or model_id
-        e["prompt_hash"] = e.get("prompt_hash") or hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:12]
-        e["retrieval_ids"] = e.get("retrieval_ids") or [f"KE-{r['id']}" for r in retrieved]
-        data["enrichment"] = e
-        # also ensure cover.client is set
-        cov = data.get("cover", {})
-        if not cov.get("client"):
-            cov["client"] = client_name
-        data["cover"] = cov
-        report_json = json.dumps(data, ensure_ascii=False)
-
-        # DOCX
-        out_path = ensure_output_dir() / f"deliverable_{client_name.replace(' ', '_')}.docx"
-        create_word_document_from_json(out_path, report_json)
-
-        # Closed-loop store deliverable
-        insert_deliverable_json(client_id, report_json, embedder)
-
-        print(f"✓ Generated deliverable for {client_name}: {out_path}")
-
+        # Also on failure: don't leak pooled connections past the run
+        close_db_pool()
     print("Pipeline complete.")
 
 if __name__ == "__main__":
@@ -28,19 +28,40 @@ CREATE TABLE stakeholders (
     priority3 VARCHAR(255)
 );
 
+-- Stakeholders are always read per client.
+CREATE INDEX stakeholders_client_id_idx ON stakeholders (client_id);
+
 -- Knowledge entries table: stores unstructured text associated with a
 -- client and optionally a stakeholder.  The `embedding` column uses
--- pgvector to store a high‑dimensional representation of the entry.
+-- pgvector to store a high‑dimensional representation of the entry as
+-- half-precision floats (`halfvec`, pgvector >= 0.7): 768 bytes per row
+-- instead of 1536, with negligible effect on retrieval quality.
 CREATE TABLE knowledge_entries (
     id SERIAL PRIMARY KEY,
     client_id INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
     stakeholder_id INTEGER REFERENCES stakeholders(id) ON DELETE SET NULL,
     type VARCHAR(50) NOT NULL,
     content TEXT NOT NULL,
-    embedding vector(384),
+    embedding halfvec(384),
     created_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- B-tree indexes on the foreign keys.  (client_id, created_at) serves both
+-- the per-client filter and the newest-entries fallback; stakeholder_id
+-- keeps the ON DELETE SET NULL from scanning the table.
+CREATE INDEX knowledge_entries_client_created_idx
+    ON knowledge_entries (client_id, created_at DESC);
+CREATE INDEX knowledge_entries_stakeholder_id_idx
+    ON knowledge_entries (stakeholder_id);
+
+-- Approximate nearest-neighbour index for semantic retrieval.  Embeddings
+-- are L2-normalised when stored, so the Python script ranks by inner
+-- product (`<#>`), which orders like cosine distance but skips the norm
+-- computation.
+CREATE INDEX knowledge_entries_embedding_hnsw
+    ON knowledge_entries USING hnsw (embedding halfvec_ip_ops)
+    WITH (m = 16, ef_construction = 64);
+
 -- Sample data.  Two clients with one stakeholder each and several
 -- knowledge entries.  The embeddings will be computed and updated
 -- by the Python script.